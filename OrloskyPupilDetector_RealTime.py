@@ -426,12 +426,90 @@ def crop_frame(frame, crop_width, crop_height):
     start_y = frame_height - crop_height
     return frame[start_y:frame_height, start_x:start_x + crop_width]
 
+# Multipart boundary and headers that precede every JPEG in the MJPEG stream
+FRAME_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+
+
+class FrameBroker:
+    """Holds the latest JPEG from the camera thread and wakes every streaming client when it changes."""
+
+    def __init__(self):
+        self.frame = None  # Latest JPEG
+        self.part = None   # Latest JPEG framed as an MJPEG part, shared by all clients
+        self.events = {}  # One event per client thread
+        self._lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        """Block the calling client until a new frame is published. Returns None if the timeout expires first."""
+        ident = threading.get_ident()
+        with self._lock:
+            event = self.events.get(ident)
+            if event is None:
+                event = self.events[ident] = threading.Event()
+                if self.frame is not None:
+                    event.set()  # New clients get the current frame straight away
+        if not event.wait(timeout):
+            return None
+        event.clear()
+        return self.part
+
+    def publish(self, jpeg):
+        """Replace the latest frame and notify all clients. Slow clients simply skip frames."""
+        # cv2.imencode returns an array sized to the encoded payload, so this copies only the JPEG bytes
+        frame = jpeg.tobytes()
+        self.part = b''.join((FRAME_HEADER, frame, b'\r\n'))
+        self.frame = frame
+        with self._lock:
+            for event in self.events.values():
+                event.set()
+
+    def leave(self):
+        """Forget the calling client once its stream ends."""
+        with self._lock:
+            self.events.pop(threading.get_ident(), None)
+
+
+class LatestSlot:
+    """Single-slot frame holder. put() overwrites whatever is there, so readers only ever see the newest frame."""
+
+    def __init__(self):
+        self._f = None
+        self._lk = threading.Lock()
+        self._ev = threading.Event()
+
+    def put(self, f):
+        with self._lk:
+            self._f = f
+            self._ev.set()
+
+    def get(self):
+        """Block until a frame newer than the last one taken is available."""
+        self._ev.wait()
+        with self._lk:
+            self._ev.clear()
+            return self._f
+
+
+def capture_frames(cap, slot, stop_event):
+    """Keep reading the camera so frames pile up in the slot rather than in the driver's queue."""
+    try:
+        while not stop_event.is_set():
+            ret, frame = cap.read()
+            if not ret:
+                break
+            slot.put(frame)
+    finally:
+        slot.put(None)  # Tell the reader the capture has ended
+
+
 # Global control flags
 storing_coordinates = False
 coordinates_list = []  # Store coordinates and gaze data
 gaze_count = 0
 total_logging_seconds = 0
 stop_camera = False
+frame_broker = FrameBroker()
+camera_ready = threading.Event()  # Set once the camera loop has published a frame
 
 
 def process_video_realtime():
@@ -442,9 +520,11 @@ def process_video_realtime():
     cap = cv2.VideoCapture(0)
     cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
     cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Don't let the driver queue stale frames
 
     if not cap.isOpened():
         print("Error: Could not access the camera.")
+        cap.release()
         return
 
     # Cropping dimensions
@@ -459,61 +539,77 @@ def process_video_realtime():
 
     if start_x + crop_width > 1280 or start_y + crop_height > 720:
         print("Error: Cropping dimensions exceed the camera resolution.")
+        cap.release()
         return
 
     last_logged_time = 0
     start_time = time.time()
     stop_camera = False  # Reset flag
 
-    while not stop_camera:
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        # Crop frame
-        cropped_frame = frame[start_y:start_y + crop_height, start_x:start_x + crop_width]
-
-        # Draw gaze area
-        cv2.circle(cropped_frame, (initial_x, initial_y), radius, (0, 0, 255), 2)
-
-        # Process frame to find pupil
-        final_rotated_rect = process_frame(cropped_frame)
-
-        center_x, center_y = (None, None)
-        if final_rotated_rect:
-            center_x, center_y = map(int, final_rotated_rect[0])
-
-        elapsed_time = time.time() - start_time
-
-        # Log data
-        if storing_coordinates and int(elapsed_time) > last_logged_time:
-            last_logged_time = int(elapsed_time)
-            total_logging_seconds += 1
-
-            # Calculate gaze status
-            gaze = 0
-            if center_x is not None and center_y is not None:
-                distance = math.sqrt((center_x - initial_x) ** 2 + (center_y - initial_y) ** 2)
-                gaze = 1 if distance <= radius else 0
-                gaze_count += gaze
-
-            # Append to coordinates list
-            coordinates_list.append({"time": elapsed_time, "x": center_x, "y": center_y, "gaze": gaze})
-
-        # Display frame
-        if final_rotated_rect:
-            ellipse = final_rotated_rect
-            cv2.ellipse(cropped_frame, ellipse, (0, 255, 0), 2)
-            center_x, center_y = map(int, ellipse[0])
-            cv2.circle(cropped_frame, (center_x, center_y), 3, (0, 255, 0), -1)
-
-        cv2.imshow("Pupil Tracking (Cropped)", cropped_frame)
-
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-
-    cap.release()
-    cv2.destroyAllWindows()
+    # Read the camera on its own thread and drop every frame except the newest
+    latest_frame = LatestSlot()
+    stop_capture = threading.Event()
+    capture_thread = threading.Thread(target=capture_frames, args=(cap, latest_frame, stop_capture), daemon=True)
+    capture_thread.start()
+
+    try:
+        while not stop_camera:
+            frame = latest_frame.get()
+            if frame is None:
+                break
+
+            # Crop frame
+            cropped_frame = frame[start_y:start_y + crop_height, start_x:start_x + crop_width]
+
+            # Draw gaze area
+            cv2.circle(cropped_frame, (initial_x, initial_y), radius, (0, 0, 255), 2)
+
+            # Process frame to find pupil
+            final_rotated_rect = process_frame(cropped_frame)
+
+            center_x, center_y = (None, None)
+            if final_rotated_rect:
+                center_x, center_y = map(int, final_rotated_rect[0])
+
+            elapsed_time = time.time() - start_time
+
+            # Log data
+            if storing_coordinates and int(elapsed_time) > last_logged_time:
+                last_logged_time = int(elapsed_time)
+                total_logging_seconds += 1
+
+                # Calculate gaze status
+                gaze = 0
+                if center_x is not None and center_y is not None:
+                    distance = math.sqrt((center_x - initial_x) ** 2 + (center_y - initial_y) ** 2)
+                    gaze = 1 if distance <= radius else 0
+                    gaze_count += gaze
+
+                # Append to coordinates list
+                coordinates_list.append({"time": elapsed_time, "x": center_x, "y": center_y, "gaze": gaze})
+
+            # Display frame
+            if final_rotated_rect:
+                ellipse = final_rotated_rect
+                cv2.ellipse(cropped_frame, ellipse, (0, 255, 0), 2)
+                center_x, center_y = map(int, ellipse[0])
+                cv2.circle(cropped_frame, (center_x, center_y), 3, (0, 255, 0), -1)
+
+            # Share the annotated frame with the MJPEG clients
+            _, jpeg = cv2.imencode('.jpg', cropped_frame)
+            frame_broker.publish(jpeg)
+            camera_ready.set()
+
+            cv2.imshow("Pupil Tracking (Cropped)", cropped_frame)
+
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+    finally:
+        # Always stop the capture thread and free the camera, even if processing a frame raised
+        stop_capture.set()
+        capture_thread.join()
+        cap.release()
+        cv2.destroyAllWindows()
 
 # # Global control flags
 # storing_coordinates = False
@@ -629,65 +725,17 @@ def stop_logging():
     print("gaze_count" + str(gaze_count) + "total_logging_seconds" + str(total_logging_seconds))
     return {"gaze_patterns": coordinates_list, "focus_index": f"{average_gaze_percentage:.2f}%"}
 
-from flask import Response
-
 def generate_video_feed():
-    """Yield video frames as a response for MJPEG streaming with valid area and pupil detection."""
-    global storing_coordinates, output_csv_path, gaze_count, total_logging_seconds
-
-    # Open the default camera (index 0)
-    cap = cv2.VideoCapture(0)
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
-
-    if not cap.isOpened():
-        print("Error: Could not access the camera.")
-        return
-
-    # Cropping parameters (centered at (705, 374))
-    crop_width = 640
-    crop_height = 480
-    center_x = 705
-    center_y = 374
-
-    # Gaze calculation parameters (initial point and radius)
-    initial_x = 330
-    initial_y = 272
-    radius = 230  # Radius threshold for gaze area
-
-    # Calculate the cropping start (x, y) coordinates
-    start_x = max(0, center_x - crop_width // 2)
-    start_y = max(0, center_y - crop_height // 2)
-
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            print("Error: Failed to read from the camera.")
-            break
-
-        # Crop the frame based on the specified dimensions
-        cropped_frame = frame[start_y:start_y + crop_height, start_x:start_x + crop_width]
-
-        # Draw the valid gaze area (red circle)
-        cv2.circle(cropped_frame, (initial_x, initial_y), radius, (0, 0, 255), 2)
-
-        # Process the cropped frame and find the pupil (using an external function)
-        final_rotated_rect = process_frame(cropped_frame)  # Assumes process_frame is defined elsewhere
-
-        if final_rotated_rect:
-            # Draw the detected pupil
-            ellipse = final_rotated_rect
-            cv2.ellipse(cropped_frame, ellipse, (0, 255, 0), 2)  # Draw the detected ellipse
-            pupil_center_x, pupil_center_y = map(int, ellipse[0])
-            cv2.circle(cropped_frame, (pupil_center_x, pupil_center_y), 3, (0, 255, 0), -1)  # Draw center point
-
-        # Encode the frame as JPEG
-        _, jpeg = cv2.imencode('.jpg', cropped_frame)
-        frame_bytes = jpeg.tobytes()
-
-        # Yield the frame as part of the MJPEG response
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-
-    # Release the camera resource
-    cap.release()
+    """Yield the frames published by the camera thread as an MJPEG stream."""
+    try:
+        while True:
+            part = frame_broker.wait(timeout=2)
+            if part is None:
+                if not camera_ready.is_set():
+                    break  # The camera went down, end the stream rather than hold the thread forever
+                continue
+
+            # Yield the shared, already framed part as-is
+            yield part
+    finally:
+        frame_broker.leave()
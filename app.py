@@ -1,16 +1,36 @@
 from flask import Flask, request, jsonify, Response
+from flask.json.provider import JSONProvider
+import orjson
 import threading
+import collections
+import time
+import math
 import os
+import uuid
 import pickle
-import pandas as pd
 import numpy as np
 from pymongo import MongoClient
+from pymongo.write_concern import WriteConcern
+from bson.binary import Binary
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
 from flask_cors import CORS
 from dotenv import load_dotenv
-from OrloskyPupilDetector_RealTime import process_video_realtime, start_logging, stop_logging, generate_video_feed
+from OrloskyPupilDetector_RealTime import process_video_realtime, start_logging, stop_logging, generate_video_feed, frame_broker, camera_ready
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson for request parsing and jsonify()."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 load_dotenv()
 
@@ -18,19 +38,193 @@ load_dotenv()
 MONGO_URI = os.getenv("MONGO_URI")
 if not MONGO_URI:
     raise ValueError("MONGO_URI is not set in the environment")
-client = MongoClient(MONGO_URI)
+# Only a few writers run at once (stop requests and the /stopAll executor), so keep the pool small.
+# Bulk sample writes skip the journal wait, candidate summaries still wait for a majority.
+client = MongoClient(MONGO_URI, maxPoolSize=8, w=1, journal=False, compressors="zstd")
 db = client["JobRecVR"]
-collection = db["biometrics_gaze"]
+collection = db.get_collection("biometrics_gaze", write_concern=WriteConcern(w="majority"))
+collection_samples = db["biometrics_samples"]
+samples_index_ready = False  # candidateId index is created on first save, not at import
+
+# Each /video_feed viewer holds a server thread while it streams, so cap them below the
+# gunicorn thread count (see gunicorn.conf.py) to keep threads free for the other endpoints
+MAX_VIDEO_STREAMS = 16
+video_streams = threading.BoundedSemaphore(MAX_VIDEO_STREAMS)
+
+# Background workers for the MongoDB writes of /stopAll
+EXECUTOR = ThreadPoolExecutor(max_workers=4)
+MAX_JOBS = 100  # Past this, the oldest finished jobs are forgotten even if nobody polled them
+jobs = collections.OrderedDict()
+_jobs_lock = threading.Lock()
+
+
+# One sensor sample as (HR, TEMP, ts), used to convert queued tuples in bulk
+SAMPLE_DTYPE = np.dtype([("hr", np.float32), ("temp", np.float32), ("ts", np.int64)])
+FLOAT32_MAX = float(np.finfo(np.float32).max)
+
+
+class BiometricBuffer:
+    """Thread-safe, growable buffer of HR/TEMP samples stored as NumPy arrays."""
+
+    def __init__(self, capacity=1024):
+        self._lock = threading.Lock()
+        self._x = np.empty((capacity, 2), np.float32)  # HR, TEMP rows laid out as the model's features
+        self._ts = np.empty(capacity, np.int64)         # unix epoch in nanoseconds
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def extend(self, rows):
+        """Append an array of SAMPLE_DTYPE rows in one pass."""
+        k = len(rows)
+        with self._lock:
+            i = self._size
+            if i + k > len(self._x):
+                # Out of room, copy into arrays of at least double the capacity
+                capacity = max(2 * len(self._x), i + k)
+                x = np.empty((capacity, 2), np.float32)
+                x[:i] = self._x[:i]
+                self._x = x
+                self._ts = np.resize(self._ts, capacity)
+            self._x[i:i + k, 0] = rows["hr"]
+            self._x[i:i + k, 1] = rows["temp"]
+            self._ts[i:i + k] = rows["ts"]
+            self._size = i + k
+
+    def to_document(self, candidate_id):
+        """Return the buffered samples as one document holding the raw array bytes.
+
+        Read back with np.frombuffer(doc["hr"], np.float32) (same for "temp") and
+        np.frombuffer(doc["ts"], np.int64).
+        """
+        with self._lock:
+            n = self._size
+            x = self._x[:n]
+            ts = self._ts[:n]
+        return {
+            "candidateId": candidate_id,
+            "n": n,
+            "dtype": "f4",
+            "hr": Binary(x[:, 0].tobytes()),
+            "temp": Binary(x[:, 1].tobytes()),
+            "ts": Binary(ts.tobytes())
+        }
+
+
+def format_timestamp(ts):
+    return datetime.fromtimestamp(ts / 1e9).strftime("%Y-%m-%d %H:%M:%S")
+
+
+@dataclass
+class StressTotals:
+    """Running stress predictions for a session, updated as each batch of samples is buffered."""
+    stress_sum: float = 0.0
+    count: int = 0
+    temp_min: float = float("inf")
+    temp_max: float = float("-inf")
+
+    def add(self, X):
+        P = MODEL.predict(X)
+        self.stress_sum += float(P.sum())
+        self.count += len(P)
+        self.temp_min = min(self.temp_min, float(X[:, 1].min()))
+        self.temp_max = max(self.temp_max, float(X[:, 1].max()))
+
+
+@dataclass(frozen=True)
+class Session:
+    """A stress logging session: the candidate ID, the samples collected for it and their running stress totals."""
+    id: str
+    buffer: BiometricBuffer = field(default_factory=BiometricBuffer)
+    totals: StressTotals = field(default_factory=StressTotals)
+
 
 # Shared variables
-buffered_data = []
-is_logging = False
-current_id = None
+latest_sample = None  # Most recent (HR, TEMP, ts) from the sensor, whether logging or not
+_session = None       # Active Session, only ever replaced through _swap_session()
+_session_lock = threading.Lock()
+
+
+def _swap_session(new_session):
+    """Atomically install new_session and return the session it replaced."""
+    global _session
+    with _session_lock:
+        old_session, _session = _session, new_session
+    return old_session
+
+
+# Sensor samples queued by /data and moved into the active session by a single consumer thread.
+# deque.append and deque.popleft are atomic, so neither side needs a lock.
+INGEST = collections.deque(maxlen=65536)
+_drain_lock = threading.Lock()  # Held by the consumer while it handles a batch
+
+
+def _buffer_rows(session, rows):
+    """Predict rows into the session totals, then buffer them. Returns False if predict failed."""
+    try:
+        # Predict as samples arrive so stopping a session needs no inference.
+        # Buffer only after predict succeeds so the totals always match the stored samples.
+        session.totals.add(np.column_stack((rows["hr"], rows["temp"])))
+    except Exception as e:
+        print(f"Error: Failed to predict stress for {len(rows)} biometric sample(s): {e}")
+        return False
+    session.buffer.extend(rows)
+    return True
+
+
+def _drain_ingest():
+    while True:
+        with _drain_lock:
+            # Take everything queued so far and buffer it as one batch
+            batch = []
+            try:
+                while True:
+                    batch.append(INGEST.popleft())
+            except IndexError:
+                pass
+
+            session = _session
+            if batch and session is not None:
+                rows = np.fromiter(batch, dtype=SAMPLE_DTYPE, count=len(batch))
+                if not _buffer_rows(session, rows):
+                    # Retry one row at a time so a bad sample only loses itself
+                    for i in range(len(rows)):
+                        _buffer_rows(session, rows[i:i + 1])
+
+        if not batch:
+            time.sleep(0.01)
+
+
+def _end_session(timeout=1.0):
+    """Take the active session once the samples that arrived before the stop have been buffered."""
+    deadline = time.monotonic() + timeout
+    while INGEST and time.monotonic() < deadline:
+        time.sleep(0.005)
+
+    # Swap under the consumer's lock, so no batch can touch the session after it is handed off
+    with _drain_lock:
+        return _swap_session(None)
+
+
+threading.Thread(target=_drain_ingest, daemon=True).start()
+
+
+# Keep the camera process running, restarting it whenever it fails or stops
+def _supervise_camera():
+    while True:
+        try:
+            process_video_realtime()
+        except Exception as e:
+            print(f"Error: Camera process failed: {e}")
+        finally:
+            camera_ready.clear()
+        time.sleep(1)
 
 
 # Start camera process in a separate thread
 def start_camera_process():
-    thread = threading.Thread(target=process_video_realtime, daemon=True)
+    thread = threading.Thread(target=_supervise_camera, daemon=True)
     thread.start()
 
 
@@ -41,19 +235,53 @@ def load_model():
         return data["cls"]
 
 
-# Predict stress level
-def predict_stress_from_data(data):
-    df = pd.DataFrame(data)
+# Load the model once at import and warm it up with a dummy (HR, TEMP) row
+MODEL = load_model()
+MODEL.predict(np.zeros((1, 2)))
 
-    TEMP = df["TEMP"].values
-    if sum((TEMP < 26) | (TEMP > 38)):
-        return {"status": "failure", "message": "The temperature should be between 26 and 38"}
 
-    X = df.drop(columns=["datetime"]).values
-    model = load_model()
-    P = model.predict(X)
+# Index samples by candidate once, lazily so importing the app never waits on MongoDB
+def ensure_samples_index():
+    global samples_index_ready
+    if samples_index_ready:
+        return
+    try:
+        collection_samples.create_index("candidateId")
+        samples_index_ready = True
+    except Exception as e:
+        print(f"Error: Could not create the biometrics_samples index: {e}")
+
+
+# Write the buffered samples to their own collection as packed arrays
+def save_samples(candidate_id, data):
+    sample_count = len(data)
+    if sample_count:
+        ensure_samples_index()
+        collection_samples.insert_one(data.to_document(candidate_id))
+    return sample_count
+
+
+# Build the candidate document, with null stress fields when no stress could be predicted
+def build_candidate_record(candidate_id, stress_result, sample_count):
+    succeeded = stress_result["status"] == "success"
+    return {
+        "candidateId": candidate_id,
+        "averageStress": stress_result["average_stress"] if succeeded else None,
+        "stressStatus": stress_result["stress"] if succeeded else None,
+        "sampleCount": sample_count
+    }
 
-    avg_stress = np.sum(P) / (len(P) * 2)
+
+# Predict stress level from a session's running totals
+def predict_stress_from_data(totals):
+    if totals.count == 0:
+        return {"status": "failure", "message": "No biometric data was recorded"}
+
+    if totals.temp_min < 26 or totals.temp_max > 38:
+        return {"status": "failure", "message": "The temperature should be between 26 and 38"}
+
+    # Labels are 0-2, so halve the mean prediction
+    avg_stress = totals.stress_sum / (totals.count * 2)
 
     if avg_stress < 0.25:
         status = "Resilient"
@@ -90,42 +318,48 @@ def stop_logging_endpoint():
 @app.route('/video_feed')
 def video_feed():
     """Video streaming route with continuous feed."""
-    return Response(generate_video_feed(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    if not camera_ready.wait(timeout=2):
+        return "Error: Camera is not available.", 503
+    if not video_streams.acquire(blocking=False):
+        return "Error: Too many video streams open, try /snapshot.jpg instead.", 503
+
+    response = Response(generate_video_feed(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    response.call_on_close(video_streams.release)  # Runs even if the stream never started
+    return response
+
+
+@app.route('/snapshot.jpg')
+def snapshot():
+    """Latest camera frame as a single JPEG, for clients that re-request once the previous image has loaded."""
+    frame = frame_broker.frame
+    if frame is None or not camera_ready.is_set():
+        return "Error: Camera is not available.", 503
+    return Response(frame, mimetype='image/jpeg', headers={'Cache-Control': 'no-store'})
 
 
 # Routes for Stress Deployment
 @app.route('/startLogging', methods=['POST'])
 def start_logging_stress():
-    global is_logging, buffered_data, current_id
     body = request.get_json()
     current_id = body.get('id')
 
     if not current_id:
         return jsonify({"status": "failure", "message": "ID is required"}), 400
 
-    is_logging = True
-    buffered_data = []
+    _swap_session(Session(current_id))
     return jsonify({"status": "success", "message": f"Logging started for ID {current_id}"}), 200
 
 
 @app.route('/stopLogging', methods=['POST'])
 def stop_logging_stress():
-    global is_logging, buffered_data, current_id
+    session = _end_session()
 
-    if is_logging:
-        stress_result = predict_stress_from_data(buffered_data)
-
-        candidate_record = {
-            "candidateId": current_id,
-            "averageStress": stress_result["average_stress"],
-            "stressStatus": stress_result["stress"],
-            "biometrics": buffered_data
-        }
+    if session is not None:
+        stress_result = predict_stress_from_data(session.totals)
+        sample_count = save_samples(session.id, session.buffer)
 
+        candidate_record = build_candidate_record(session.id, stress_result, sample_count)
         collection.insert_one(candidate_record)
-        buffered_data = []
-        is_logging = False
-        current_id = None
 
         return jsonify({
             "status": "success",
@@ -199,7 +433,7 @@ def stop_logging_stress():
 #             return jsonify({"status": "failure", "message": "No data available"}), 404
 @app.route('/data', methods=['GET', 'POST'])
 def receive_data():
-    global buffered_data
+    global latest_sample
 
     if request.method == 'POST':
         # Handle POST requests to receive real-time data from the sensor
@@ -207,33 +441,39 @@ def receive_data():
         bpm = data.get('bpm', None)
         temp = data.get('temperature', None)
 
-        print(f"Received data: {data}")
-
         # If bpm or temp is missing, send an error response
         if bpm is None or temp is None:
             return jsonify({"status": "failure", "message": "Missing bpm or temperature"}), 400
 
-        # Store the latest data in buffered_data
-        new_entry = {
-            "HR": bpm,
-            "TEMP": temp,
-            "datetime": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
+        # Reject values the consumer could not convert, so one bad sample can't spoil a batch
+        try:
+            bpm = float(bpm)
+            temp = float(temp)
+        except (TypeError, ValueError):
+            return jsonify({"status": "failure", "message": "bpm and temperature must be numbers"}), 400
+
+        # NaN, infinities and values that overflow float32 would break prediction in the consumer
+        if not all(math.isfinite(v) and abs(v) <= FLOAT32_MAX for v in (bpm, temp)):
+            return jsonify({"status": "failure", "message": "bpm and temperature must be finite numbers"}), 400
 
-        # Append to buffered data (no need for is_logging here, as we're just collecting sensor data)
-        buffered_data.append(new_entry)
+        ts = time.time_ns()
+        latest_sample = (bpm, temp, ts)
 
-        return jsonify({"status": "success"}), 200
+        # Queue the sample for the active session, if any, and reply right away
+        INGEST.append((bpm, temp, ts))
+
+        return '', 204
 
     elif request.method == 'GET':
         # Handle GET requests to fetch the most recent BPM and temperature
-        if buffered_data:
-            latest_data = buffered_data[-1]  # Fetch the latest entry from buffered_data
+        latest_data = latest_sample
+        if latest_data:
+            hr, temp, ts = latest_data
             return jsonify({
                 "status": "success",
-                "bpm": latest_data["HR"],
-                "temperature": latest_data["TEMP"],
-                "datetime": latest_data["datetime"]
+                "bpm": hr,
+                "temperature": temp,
+                "datetime": format_timestamp(ts)
             }), 200
         else:
             return jsonify({"status": "failure", "message": "No data available"}), 404
@@ -241,8 +481,6 @@ def receive_data():
 @app.route('/startAll', methods=['POST'])
 def start_all_logging():
     """Start both stress and gaze logging."""
-    global is_logging, buffered_data, current_id
-
     # Start stress logging
     body = request.get_json()
     current_id = body.get('id')
@@ -250,54 +488,79 @@ def start_all_logging():
     if not current_id:
         return jsonify({"status": "failure", "message": "ID is required"}), 400
 
-    is_logging = True
-    buffered_data = []
+    _swap_session(Session(current_id))
 
     # Start gaze logging
     start_logging()
 
     return jsonify({"status": "success", "message": "Logging started for both stress and gaze."}), 200
 
+def _finalize(session, gaze_result):
+    """Summarise stress for a finished session and save it to the database."""
+    stress_result = predict_stress_from_data(session.totals)
+    sample_count = save_samples(session.id, session.buffer)
+
+    candidate_record = build_candidate_record(session.id, stress_result, sample_count)
+    candidate_record["gaze_patterns"] = gaze_result["gaze_patterns"]  # Store gaze data
+    candidate_record["focus_index"] = gaze_result["focus_index"]      # Average gaze percentage
+    collection.insert_one(candidate_record)
+    return stress_result
+
+
 @app.route('/stopAll', methods=['POST'])
 def stop_all_logging():
-    """Stop both stress and gaze logging and save results to the database."""
-    global is_logging, buffered_data, current_id
-
+    """Stop both stress and gaze logging and save results to the database in the background."""
     # Stop stress logging
-    if is_logging:
-        stress_result = predict_stress_from_data(buffered_data)
+    session = _end_session()
 
+    if session is not None:
         # Stop gaze logging
         gaze_result = stop_logging()
 
-        # Save to database
-        candidate_record = {
-            "candidateId": current_id,
-            "averageStress": stress_result["average_stress"],
-            "stressStatus": stress_result["stress"],
-            "gaze_patterns": gaze_result["gaze_patterns"],  # Store gaze data
-            "focus_index": gaze_result["focus_index"],      # Average gaze percentage
-            "biometrics": buffered_data                     # Stress data
-        }
-        collection.insert_one(candidate_record)
-
-        # Reset logging state
-        buffered_data = []
-        is_logging = False
-        current_id = None
+        # Save to database without holding up the request
+        job_id = uuid.uuid4().hex
+        future = EXECUTOR.submit(_finalize, session, gaze_result)
+        with _jobs_lock:
+            jobs[job_id] = future
+            # Never evict a running job, its client may still be polling it
+            for old_id in [i for i, f in jobs.items() if f.done()][:max(0, len(jobs) - MAX_JOBS)]:
+                del jobs[old_id]
 
         return jsonify({
             "status": "success",
-            "message": "Logging stopped and data saved to MongoDB",
-            "stress_result": stress_result,
+            "message": "Logging stopped, saving data to MongoDB",
+            "jobId": job_id,
             "gaze_result": gaze_result["focus_index"]
-        }), 200
+        }), 202
     else:
         return jsonify({"status": "failure", "message": "Logging is not currently active"}), 400
 
+
+@app.route('/jobStatus/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Report the outcome of a /stopAll job. Finished jobs are forgotten once reported."""
+    with _jobs_lock:
+        future = jobs.get(job_id)
+        if future is not None and future.done():
+            jobs.pop(job_id, None)
+
+    if future is None:
+        return jsonify({"status": "failure", "message": "Unknown job ID"}), 404
+
+    if not future.done():
+        return jsonify({"status": "pending"}), 200
+
+    error = future.exception()
+    if error is not None:
+        return jsonify({"status": "failure", "message": f"{type(error).__name__}: {error}"}), 500
+
+    return jsonify({
+        "status": "success",
+        "message": "Data saved to MongoDB",
+        "stress_result": future.result()
+    }), 200
+
 if __name__ == '__main__':
-    # Start the camera process
+    # Development server only, serve with `gunicorn app:app` (see gunicorn.conf.py) otherwise
     start_camera_process()
-
-    # Start the Flask app
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,20 @@
+# Gunicorn settings for serving the Flask app
+# Run with: gunicorn app:app
+
+bind = "0.0.0.0:5000"
+
+# Only one worker may own the camera. Each MJPEG viewer holds one of its threads,
+# so app.py caps /video_feed at MAX_VIDEO_STREAMS (16) and answers 503 past that.
+# That keeps at least 16 threads free for /data and the stop endpoints.
+workers = 1
+worker_class = "gthread"
+threads = 32
+
+# Import the app after the fork so the MongoClient is created inside the worker
+preload_app = False
+
+
+def post_worker_init(worker):
+    # Start the camera process once the worker has loaded the app
+    from app import start_camera_process
+    start_camera_process()